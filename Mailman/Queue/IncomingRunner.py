@@ -96,7 +96,6 @@
 
 import sys
 import os
-from io import StringIO
 
 from Mailman import mm_cfg
 from Mailman import Errors
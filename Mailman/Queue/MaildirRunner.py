@@ -41,7 +41,8 @@ purposes.  The :1 can be followed by one of these letters:
   MaildirRunner will never automatically return to this file, but once the
   problem is fixed, you can manually move the file back to the new/ directory
   and MaildirRunner will attempt to re-process it.  At some point we may do
-  this automatically.
+  this automatically.  If a <filename>:1,X file already exists, the new one
+  is called <filename>.<n>:1,X instead, for the first unused number n.
 
 See the variable USE_MAILDIR in Defaults.py.in for enabling this delivery
 mechanism.
@@ -49,12 +50,11 @@ mechanism.
 
 # NOTE: Maildir delivery is experimental in Mailman 2.1.
 
-from builtins import str
 import os
-import re
+import zlib
 import errno
 
-from email.Parser import Parser
+from email.parser import HeaderParser
 from email.utils import parseaddr
 
 from Mailman import mm_cfg
@@ -66,25 +66,175 @@ from Mailman.Logging.Syslog import syslog
 
 # We only care about the listname and the subq as in listname@ or
 # listname-request@
-lre = re.compile(r"""
- ^                        # start of string
- (?P<listname>[^+@]+?)    # listname@ or listname-subq@ (non-greedy)
- (?:                      # non-grouping
-   -                      # dash separator
-   (?P<subq>              # any known suffix
-     admin|
-     bounces|
-     confirm|
-     join|
-     leave|
-     owner|
-     request|
-     subscribe|
-     unsubscribe
-   )
- )?                       # if it exists
- [+@]                     # followed by + or @
- """, re.VERBOSE | re.IGNORECASE)
+_SUBQ_SET = frozenset((
+    'admin',
+    'bounces',
+    'confirm',
+    'join',
+    'leave',
+    'owner',
+    'request',
+    'subscribe',
+    'unsubscribe',
+    ))
+
+
+def _parse_local(to):
+    # Split the local part of `to', i.e. everything before the first + or @,
+    # into a (listname, subq) tuple.  subq is None when the local part has no
+    # known -suffix.  Return None when `to' isn't an address we care about.
+    i = to.find('@')
+    j = to.find('+')
+    if j >= 0 and (i < 0 or j < i):
+        i = j
+    if i <= 0:
+        return None
+    local = to[:i].lower()
+    listname, dash, subq = local.rpartition('-')
+    if listname and subq in _SUBQ_SET:
+        return listname, subq
+    return local, None
+
+
+# Characters that can't appear in a plain address, but can in a field that
+# needs the full RFC 2822 parser, e.g. comments, quoted names, lists, groups,
+# source routes, domain literals, or quoted pairs.
+_FANCY = frozenset(' \t"(),<>:;[]\\')
+
+
+def _quick_addr(field):
+    # Return the address in a header field that is either a bare address or
+    # `name <address>', which is nearly always what the MTA gives us.  Return
+    # None if the field looks any fancier than that, so the caller can fall
+    # back to parseaddr().
+    lt = field.find('<')
+    gt = field.rfind('>')
+    if lt >= 0 and gt > lt:
+        addr = field[lt+1:gt].strip()
+    else:
+        addr = field.strip()
+    if _FANCY.isdisjoint(addr):
+        return addr
+    return None
+
+
+def _read_headers(fd):
+    # Read the message in fd up to the blank line that ends its headers, or
+    # to the end of the file if there isn't one.  The headers are all we need
+    # to route the message, and the body may be large.  Some of the body may
+    # come along with the last chunk read, which the header parser ignores.
+    head = b''
+    while True:
+        chunk = os.read(fd, 8192)
+        if not chunk:
+            return head
+        # The blank line may straddle two chunks.
+        start = max(len(head) - 2, 0)
+        head += chunk
+        if head.find(b'\n\n', start) >= 0 or \
+               head.find(b'\n\r\n', start) >= 0:
+            return head
+
+
+# We only ever parse the headers, to find out where a message should go.
+_parser = HeaderParser(Message)
+
+
+def _parse_headers(head):
+    # Parse the header bytes read by _read_headers().  Decode them ourselves
+    # first: given bytes, the email package returns fields containing 8-bit
+    # characters (e.g. in SMTPUTF8 mail) as email.header.Header objects
+    # rather than as strings, and the address parsing below can't cope.
+    return _parser.parsestr(head.decode('utf-8', 'replace'))
+
+
+def _find_list(msg, listnames):
+    # Figure out which queue of which list this message was destined for,
+    # and return a (listname, subq) tuple.  Return None if as far as we can
+    # tell, the message isn't destined for any list in listnames.  See
+    # verp_bounce() in BounceRunner.py for why we do things this way.  The
+    # headers are tried in order of preference and the first match wins, so
+    # only look at the later ones if we have to.
+    headers = ('delivered-to', 'envelope-to', 'apparently-to')
+    fields = (field for header in headers
+              for field in msg.get_all(header, ()))
+    for field in fields:
+        to = _quick_addr(field)
+        if to is None:
+            to = parseaddr(field)[1]
+        if not to:
+            continue
+        parts = _parse_local(to)
+        if parts is None:
+            # This isn't an address we care about
+            continue
+        if parts[0] in listnames:
+            return parts
+    return None
+
+
+# Linux's renameat2() can refuse to replace an existing file, which plain
+# rename() can't.  It's only reachable through ctypes.
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+try:
+    import ctypes
+    _renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    _renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                           ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+except (ImportError, OSError, AttributeError):
+    _renameat2 = None
+
+
+def _claim(srcname, dstname):
+    # Atomically rename srcname to dstname, failing with EEXIST rather than
+    # clobbering dstname if it's already there.  On systems without
+    # renameat2(), or filesystems that don't support RENAME_NOREPLACE, link
+    # the new name and unlink the old one instead, the way maildir delivery
+    # does; link() won't clobber either.  Only one runner ever claims a given
+    # file, so it doesn't matter that this isn't atomic.
+    global _renameat2
+    if _renameat2 is not None:
+        if _renameat2(AT_FDCWD, os.fsencode(srcname),
+                      AT_FDCWD, os.fsencode(dstname), RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(err, os.strerror(err), srcname)
+        _renameat2 = None
+    try:
+        os.link(srcname, dstname)
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EOPNOTSUPP):
+            raise
+        # No hard links on this filesystem either, so check by hand
+        if os.path.lexists(dstname):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), dstname)
+        os.rename(srcname, dstname)
+    else:
+        os.unlink(srcname)
+
+
+# Map each subq to the queue directory its messages go to, and the message
+# metadata flags that tell the runner for that queue what to do.  The `None'
+# subq is a posting to the list itself.  BAW: blech, hardcoded
+_SUBQ_DISPATCH = {
+    'bounces':     (mm_cfg.BOUNCEQUEUE_DIR, {}),
+    # -admin is deprecated
+    'admin':       (mm_cfg.BOUNCEQUEUE_DIR, {}),
+    'confirm':     (mm_cfg.CMDQUEUE_DIR, {'toconfirm': 1}),
+    'join':        (mm_cfg.CMDQUEUE_DIR, {'tojoin': 1}),
+    'subscribe':   (mm_cfg.CMDQUEUE_DIR, {'tojoin': 1}),
+    'leave':       (mm_cfg.CMDQUEUE_DIR, {'toleave': 1}),
+    'unsubscribe': (mm_cfg.CMDQUEUE_DIR, {'toleave': 1}),
+    'owner':       (mm_cfg.INQUEUE_DIR, {
+        'toowner': 1,
+        'pipeline': mm_cfg.OWNER_PIPELINE,
+        }),
+    None:          (mm_cfg.INQUEUE_DIR, {'tolist': 1}),
+    'request':     (mm_cfg.CMDQUEUE_DIR, {'torequest': 1}),
+    }
 
 
 
@@ -100,98 +250,136 @@ class MaildirRunner(Runner):
         self._stop = 0
         self._dir = os.path.join(mm_cfg.MAILDIR_DIR, 'new')
         self._cur = os.path.join(mm_cfg.MAILDIR_DIR, 'cur')
-        self._parser = Parser(Message)
+        # Prefix for the file names we build in cur/ for every message
+        self._curpfx = self._cur + os.sep
+        # Like the Switchboard, we can run several MaildirRunners in parallel
+        # by giving each of them a slice of the files in new/.  A file is
+        # assigned to a slice by hashing its name, so the slices never race
+        # each other for the same file.
+        if numslices == 1:
+            self._slice = None
+        else:
+            self._slice = slice
+        self._numslices = numslices
+        # Resolve the switchboard for each sub-queue up front so we don't have
+        # to look it up again for every message.
+        self._dispatch = {}
+        for subq, (whichq, flags) in _SUBQ_DISPATCH.items():
+            self._dispatch[subq] = (get_switchboard(whichq), flags)
+        # Owner messages are sent with the site's -bounces address as the
+        # envelope sender.  This only depends on the site configuration, so
+        # compute it once and make it part of the owner sub-queue's flags.
+        queue, flags = self._dispatch['owner']
+        flags = flags.copy()
+        flags['envsender'] = Utils.get_site_email(extra='bounces')
+        self._dispatch['owner'] = (queue, flags)
+
+    def _inslice(self, file):
+        if self._slice is None:
+            return True
+        return zlib.crc32(os.fsencode(file)) % self._numslices == self._slice
 
     def _oneloop(self):
         # Refresh this each time through the list.  BAW: could be too
-        # expensive.
-        listnames = Utils.list_names()
-        # Cruise through all the files currently in the new/ directory
+        # expensive.  We test every candidate address against it, so make
+        # membership a hash lookup.
+        listnames = frozenset(Utils.list_names())
+        # Cruise through all the files currently in the new/ directory.  The
+        # directory is scanned lazily so that we can start enqueuing messages
+        # before the whole listing has been read.
         try:
-            files = os.listdir(self._dir)
+            files = os.scandir(self._dir)
         except OSError as e:
             if e.errno != errno.ENOENT: raise
             # Nothing's been delivered yet
             return 0
-        for file in files:
-            srcname = os.path.join(self._dir, file)
-            dstname = os.path.join(self._cur, file + ':1,P')
-            xdstname = os.path.join(self._cur, file + ':1,X')
+        batch = mm_cfg.MAILDIR_BATCH
+        filecnt = 0
+        with files:
+            for entry in files:
+                # Don't hog the loop when the MTA has dropped a lot of files
+                # on us.  Returning a non-zero count gets us right back here.
+                if self._shortcircuit() or (batch and filecnt >= batch):
+                    break
+                if not self._inslice(entry.name):
+                    continue
+                filecnt += 1
+                self._enqueue_one(entry, listnames)
+        return filecnt
+
+    def _setaside(self, srcname, file):
+        # Move srcname to cur/<file>:1,X.  If an earlier failure already left
+        # a file by that name, use cur/<file>.<n>:1,X for the first free n
+        # instead, so that no failed message overwrites another.  Return the
+        # new name.
+        xdstname = self._curpfx + file + ':1,X'
+        n = 0
+        while True:
             try:
-                os.rename(srcname, dstname)
+                _claim(srcname, xdstname)
+                return xdstname
             except OSError as e:
-                if e.errno == errno.ENOENT:
-                    # Some other MaildirRunner beat us to it
-                    continue
-                syslog('error', 'Could not rename maildir file: %s', srcname)
-                raise
-            # Now open, read, parse, and enqueue this message
+                if e.errno != errno.EEXIST:
+                    raise
+            n += 1
+            xdstname = '%s%s.%d:1,X' % (self._curpfx, file, n)
+
+    def _enqueue_one(self, entry, listnames):
+        file = entry.name
+        srcname = entry.path
+        dstname = self._curpfx + file + ':1,P'
+        try:
+            _claim(srcname, dstname)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # Some other MaildirRunner beat us to it
+                return
+            if e.errno == errno.EEXIST:
+                # A MaildirRunner crashed while processing a message with
+                # this name, and left the :1,P file behind.  Don't lose
+                # either copy; set this one aside for the site admin.
+                xdstname = self._setaside(srcname, file)
+                syslog('error', 'Stale maildir file %s exists, moved %s to %s',
+                       dstname, srcname, xdstname)
+                return
+            syslog('error', 'Could not rename maildir file: %s', srcname)
+            raise
+        # Now open, read, parse, and enqueue this message.  We only need
+        # the headers to route the message, so that's all we read; the file
+        # itself is copied into the queue as is and the whole message gets
+        # parsed when the target queue's runner dequeues it.
+        try:
+            fd = os.open(dstname, os.O_RDONLY)
             try:
-                fp = open(dstname)
-                try:
-                    msg = self._parser.parse(fp)
-                finally:
-                    fp.close()
-                # Now we need to figure out which queue of which list this
-                # message was destined for.  See verp_bounce() in
-                # BounceRunner.py for why we do things this way.
-                vals = []
-                for header in ('delivered-to', 'envelope-to', 'apparently-to'):
-                    vals.extend(msg.get_all(header, []))
-                for field in vals:
-                    to = parseaddr(field)[1]
-                    if not to:
-                        continue
-                    mo = lre.match(to)
-                    if not mo:
-                        # This isn't an address we care about
-                        continue
-                    listname, subq = mo.group('listname', 'subq')
-                    if listname in listnames:
-                        break
-                else:
-                    # As far as we can tell, this message isn't destined for
-                    # any list on the system.  What to do?
-                    syslog('error', 'Message apparently not for any list: %s',
-                           xdstname)
-                    os.rename(dstname, xdstname)
-                    continue
-                # BAW: blech, hardcoded
-                msgdata = {'listname': listname}
-                # -admin is deprecated
-                if subq in ('bounces', 'admin'):
-                    queue = get_switchboard(mm_cfg.BOUNCEQUEUE_DIR)
-                elif subq == 'confirm':
-                    msgdata['toconfirm'] = 1
-                    queue = get_switchboard(mm_cfg.CMDQUEUE_DIR)
-                elif subq in ('join', 'subscribe'):
-                    msgdata['tojoin'] = 1
-                    queue = get_switchboard(mm_cfg.CMDQUEUE_DIR)
-                elif subq in ('leave', 'unsubscribe'):
-                    msgdata['toleave'] = 1
-                    queue = get_switchboard(mm_cfg.CMDQUEUE_DIR)
-                elif subq == 'owner':
-                    msgdata.update({
-                        'toowner': 1,
-                        'envsender': Utils.get_site_email(extra='bounces'),
-                        'pipeline': mm_cfg.OWNER_PIPELINE,
-                        })
-                    queue = get_switchboard(mm_cfg.INQUEUE_DIR)
-                elif subq is None:
-                    msgdata['tolist'] = 1
-                    queue = get_switchboard(mm_cfg.INQUEUE_DIR)
-                elif subq == 'request':
-                    msgdata['torequest'] = 1
-                    queue = get_switchboard(mm_cfg.CMDQUEUE_DIR)
-                else:
-                    syslog('error', 'Unknown sub-queue: %s', subq)
-                    os.rename(dstname, xdstname)
-                    continue
-                queue.enqueue(msg, msgdata)
-                os.unlink(dstname)
-            except Exception as e:
-                os.rename(dstname, xdstname)
-                syslog('error', str(e))
+                head = _read_headers(fd)
+            finally:
+                os.close(fd)
+            found = _find_list(_parse_headers(head), listnames)
+            if found is None:
+                # As far as we can tell, this message isn't destined for
+                # any list on the system.  What to do?
+                xdstname = self._setaside(dstname, file)
+                syslog('error', 'Message apparently not for any list: %s',
+                       xdstname)
+                return
+            listname, subq = found
+            dispatch = self._dispatch.get(subq)
+            if dispatch is None:
+                xdstname = self._setaside(dstname, file)
+                syslog('error', 'Unknown sub-queue: %s, moved to %s',
+                       subq, xdstname)
+                return
+            queue, flags = dispatch
+            msgdata = {'listname': listname, **flags}
+            queue.enqueue_file(dstname, msgdata)
+            os.unlink(dstname)
+        except Exception as e:
+            xdstname = self._setaside(dstname, file)
+            # Don't use the exception text as the format string, it may
+            # contain stray % signs.  No traceback either; an error storm
+            # (e.g. a broken list) would spend its time formatting them.
+            syslog('error', 'Maildir enqueue failed, moved to %s: %r',
+                   xdstname, e)
 
     def _cleanup(self):
         pass
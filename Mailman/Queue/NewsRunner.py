@@ -24,7 +24,6 @@ import nntplib
 from io import StringIO
 
 import email
-from email.utils import getaddresses
 
 COMMASPACE = ', '
 
@@ -19,7 +19,8 @@
 """
 
 # enqueue() and dequeue() are not symmetric.  enqueue() takes a Message
-# object.  dequeue() returns a email.Message object tree.
+# object, and enqueue_file() the name of a file holding a raw message.
+# dequeue() returns a email.Message object tree.
 #
 # Message metadata is represented internally as a Python dictionary.  Keys and
 # values must be strings.  When written to a queue directory, the metadata is
@@ -39,6 +40,7 @@ import time
 import email
 import errno
 import pickle
+import struct
 import marshal
 
 from Mailman import mm_cfg
@@ -63,6 +65,53 @@ DELTA = .0001
 MAX_BAK_COUNT = 3
 
 
+
+def _copyfile(srcfd, dstfd, size, offset):
+    # Copy the first size bytes of srcfd into dstfd at offset.  Let the kernel
+    # do it with copy_file_range() where we can, otherwise fall back to
+    # reading and writing the data ourselves.
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    copied = 0
+    while copied < size:
+        count = size - copied
+        if copy_file_range is not None:
+            try:
+                n = copy_file_range(srcfd, dstfd, count,
+                                    copied, offset + copied)
+            except OSError as e:
+                # Not supported by this kernel or between these filesystems
+                if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                   errno.EOPNOTSUPP):
+                    raise
+                copy_file_range = None
+                continue
+        else:
+            buf = os.pread(srcfd, min(count, 1 << 20), copied)
+            n = os.pwrite(dstfd, buf, offset + copied) if buf else 0
+        if not n:
+            raise IOError(errno.EIO, 'Short copy into queue file')
+        copied += n
+
+
+
+def _message_from_bytes(raw):
+    # Parse a raw message queued by enqueue_file().  The runners expect the
+    # same str header values a message parsed from text has, but under the
+    # compat32 policy email.message_from_bytes() hands back any header with
+    # 8-bit characters in it as an email.header.Header, which get_sender()
+    # and friends choke on.  So decode the headers as UTF-8, the way
+    # MaildirRunner routes on them, and the body the way the bytes parser
+    # would, so that none of its bytes are lost.
+    end = len(raw)
+    for sep in (b'\n\n', b'\n\r\n'):
+        i = raw.find(sep)
+        if 0 <= i < end:
+            end = i + 1
+    text = (raw[:end].decode('utf-8', 'replace') +
+            raw[end:].decode('ascii', 'surrogateescape'))
+    return email.message_from_string(text, Message.Message)
+
+
 
 class Switchboard:
     def __init__(self, whichq, slice=None, numslices=1, recover=False):
@@ -106,6 +155,44 @@ class Switchboard:
             protocol = 0
             msgsave = pickle.dumps(str(_msg), protocol, fix_imports=True)
         hashfood = msgsave + listname.encode() + repr(now).encode()
+        def writemsg(fp):
+            fp.write(msgsave)
+        return self.__save(data, now, hashfood, protocol, writemsg)
+
+    def enqueue_file(self, _path, _metadata={}, **_kws):
+        # Like enqueue() with _plaintext set, for the raw message stored in
+        # _path.  The message is copied straight from _path into the queue
+        # file, in the kernel if possible, instead of being read and written
+        # back out by us.  _path is left alone; the caller removes it.
+        data = _metadata.copy()
+        data.update(_kws)
+        listname = data.get('listname', '--nolist--')
+        now = time.time()
+        fd = os.open(_path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            size = st.st_size
+            # We don't have the message bytes to hash, but the file's path and
+            # inode identify the message just as well.
+            hashfood = (os.fsencode(_path) +
+                        repr((st.st_ino, size, st.st_mtime)).encode() +
+                        listname.encode() + repr(now).encode())
+            def writemsg(fp):
+                # Frame the message as a protocol 3 pickle of a bytes object,
+                # which stores the bytes verbatim.  dequeue() parses it with
+                # _message_from_bytes().
+                header = (pickle.PROTO + b'\x03' +
+                          pickle.BINBYTES + struct.pack('<I', size))
+                fp.write(header)
+                fp.flush()
+                _copyfile(fd, fp.fileno(), size, len(header))
+                fp.seek(len(header) + size)
+                fp.write(pickle.STOP)
+            return self.__save(data, now, hashfood, 0, writemsg)
+        finally:
+            os.close(fd)
+
+    def __save(self, data, now, hashfood, protocol, writemsg):
         # Encode the current time into the file name for FIFO sorting in
         # files().  The file name consists of two parts separated by a `+':
         # the received time for this message (i.e. when it first showed up on
@@ -124,17 +211,22 @@ class Switchboard:
         # We have to tell the dequeue() method whether to parse the message
         # object or not.
         data['_parsemsg'] = (protocol == 0)
-        # Write to the pickle file the message object and metadata.
+        # Write to the pickle file the message object and metadata.  Don't
+        # leave a partly written temp file behind if that fails.
         omask = os.umask(0o007)                     # -rw-rw----
         try:
             fp = open(tmpfile, 'wb')
             try:
-                fp.write(msgsave)
-                pickle.dump(data, fp, protocol)
-                fp.flush()
-                os.fsync(fp.fileno())
-            finally:
-                fp.close()
+                try:
+                    writemsg(fp)
+                    pickle.dump(data, fp, protocol)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                finally:
+                    fp.close()
+            except:
+                os.unlink(tmpfile)
+                raise
         finally:
             os.umask(omask)
         os.rename(tmpfile, filename)
@@ -156,7 +248,10 @@ class Switchboard:
         finally:
             fp.close()
         if data.get('_parsemsg'):
-            msg = email.message_from_string(msg, Message.Message)
+            if isinstance(msg, bytes):
+                msg = _message_from_bytes(msg)
+            else:
+                msg = email.message_from_string(msg, Message.Message)
         return msg, data
 
     def finish(self, filebase, preserve=False):
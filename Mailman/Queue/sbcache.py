@@ -22,5 +22,7 @@ from Mailman.Queue.Switchboard import Switchboard
 _sbcache = {}
 
 def get_switchboard(qdir):
-    switchboard = _sbcache.setdefault(qdir, Switchboard(qdir))
+    switchboard = _sbcache.get(qdir)
+    if switchboard is None:
+        switchboard = _sbcache[qdir] = Switchboard(qdir)
     return switchboard
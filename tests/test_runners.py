@@ -17,14 +17,26 @@
 """Unit tests for the various Mailman/Queue/*Runner.py modules
 """
 
+import os
+import errno
+import pickle
+import shutil
 import unittest
 import email
+import tempfile
+from email.utils import parseaddr
 try:
     from Mailman import __init__
 except ImportError:
     import paths
 
+from Mailman import mm_cfg
+from Mailman import Utils
 from Mailman.Queue.NewsRunner import prepare_message
+from Mailman.Queue.MaildirRunner import _read_headers, _parse_headers
+from Mailman.Queue.MaildirRunner import _find_list, _quick_addr
+from Mailman.Queue import MaildirRunner
+from Mailman.Queue.Switchboard import Switchboard
 
 from TestBase import TestBase
 
@@ -112,10 +124,447 @@ A message
            ['no', 'maybe'])
 
 
+
+class TestMaildirRouting(unittest.TestCase):
+    def _read(self, text):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, text)
+            os.lseek(fd, 0, os.SEEK_SET)
+            return _read_headers(fd)
+        finally:
+            os.close(fd)
+            os.unlink(path)
+
+    def test_read_headers(self):
+        eq = self.assertEqual
+        # Long headers span several reads, and the body isn't read past the
+        # chunk holding the end of the headers.
+        headers = b'Delivered-To: _xtest@dom.ain\n' * 1000
+        body = b'A message\n' * 100000
+        head = self._read(headers + b'\n' + body)
+        eq(head[:len(headers) + 1], headers + b'\n')
+        self.assertTrue(len(head) < len(headers) + 8192 + 1)
+        # CRLF line endings
+        head = self._read(b'Delivered-To: _xtest@dom.ain\r\n\r\n' + body)
+        self.assertTrue(head.startswith(b'Delivered-To: _xtest@dom.ain\r\n'))
+        self.assertTrue(len(head) <= 8192)
+        # No body at all
+        eq(self._read(b'Delivered-To: _xtest@dom.ain\n'),
+           b'Delivered-To: _xtest@dom.ain\n')
+
+    def test_8bit_delivered_to(self):
+        # A Delivered-To with 8-bit characters in it mustn't stop us from
+        # looking at the next one.
+        msg = _parse_headers("""\
+Delivered-To: \xe9l\xe8ve@dom.ain
+Delivered-To: _xtest@dom.ain
+From: aperson@dom.ain
+
+A message
+""".encode('utf-8'))
+        self.assertEqual(msg.get_all('delivered-to'),
+                         ['\xe9l\xe8ve@dom.ain', '_xtest@dom.ain'])
+        self.assertEqual(_find_list(msg, frozenset(['_xtest'])),
+                         ('_xtest', None))
+
+    def test_8bit_not_utf8(self):
+        msg = _parse_headers(b"""\
+Delivered-To: \xe9l\xe8ve-request@dom.ain
+Envelope-To: _xtest-request@dom.ain
+
+A message
+""")
+        self.assertEqual(_find_list(msg, frozenset(['_xtest'])),
+                         ('_xtest', 'request'))
+
+    def test_header_order(self):
+        msg = _parse_headers(b"""\
+Apparently-To: _xtest-bounces@dom.ain
+Delivered-To: aperson@dom.ain
+Delivered-To: _xtest-owner@dom.ain
+
+A message
+""")
+        self.assertEqual(_find_list(msg, frozenset(['_xtest'])),
+                         ('_xtest', 'owner'))
+        self.assertEqual(_find_list(msg, frozenset(['other'])), None)
+
+    def test_quick_addr(self):
+        eq = self.assertEqual
+        # The common forms don't need parseaddr()...
+        for field in ('_xtest@dom.ain',
+                      '  _xtest-request@dom.ain\n',
+                      '<_xtest@dom.ain>',
+                      'A Person <_xtest@dom.ain>',
+                      ):
+            eq(_quick_addr(field), parseaddr(field)[1])
+        # ...and anything fancier is left to it.
+        for field in ('_xtest@dom.ain (A Person)',
+                      'A Person <_xtest@dom.ain> (comment)',
+                      '"A <b>" <_xtest@dom.ain>',
+                      'group: _xtest@dom.ain;',
+                      'group:_xtest@dom.ain;',
+                      '<@relay.dom.ain:_xtest@dom.ain>',
+                      '<@one.dom.ain,@two.dom.ain:_xtest@dom.ain>',
+                      '<aperson@dom.ain>, <_xtest@dom.ain>',
+                      '_xtest@[127.0.0.1]',
+                      '"_x\\"test"@dom.ain',
+                      ):
+            quick = _quick_addr(field)
+            self.assertTrue(quick is None or quick == parseaddr(field)[1],
+                            field)
+
+    def test_route_addr(self):
+        msg = _parse_headers(b"""\
+Delivered-To: <@relay.dom.ain:_xtest-join@dom.ain>
+
+A message
+""")
+        self.assertEqual(_find_list(msg, frozenset(['_xtest'])),
+                         ('_xtest', 'join'))
+
+
+
+class _Utils:
+    # Stands in for Mailman.Utils in MaildirRunner, so that only _xtest is a
+    # list no matter what's installed.
+    list_names = staticmethod(lambda: ['_xtest'])
+    get_site_email = staticmethod(Utils.get_site_email)
+
+
+class MaildirTestCase(unittest.TestCase):
+    # Run MaildirRunners over a temporary maildir, enqueuing into temporary
+    # switchboards, so the installed queue directories are never touched.
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._new = os.path.join(self._tmpdir, 'new')
+        self._cur = os.path.join(self._tmpdir, 'cur')
+        os.mkdir(self._new)
+        os.mkdir(self._cur)
+        self._switchboards = {}
+        self._saved = (MaildirRunner.get_switchboard, MaildirRunner.Utils)
+        MaildirRunner.get_switchboard = self._get_switchboard
+        MaildirRunner.Utils = _Utils
+
+    def tearDown(self):
+        MaildirRunner.get_switchboard, MaildirRunner.Utils = self._saved
+        shutil.rmtree(self._tmpdir)
+
+    def _get_switchboard(self, whichq):
+        if whichq not in self._switchboards:
+            self._switchboards[whichq] = Switchboard(
+                os.path.join(self._tmpdir, os.path.basename(whichq)))
+        return self._switchboards[whichq]
+
+    def _runner(self, slice=None, numslices=1):
+        runner = MaildirRunner.MaildirRunner(slice, numslices)
+        runner._dir = self._new
+        runner._cur = self._cur
+        runner._curpfx = self._cur + os.sep
+        return runner
+
+    def _write(self, path, text):
+        fp = open(path, 'wb')
+        try:
+            fp.write(text)
+        finally:
+            fp.close()
+
+    def _files(self, dir):
+        files = {}
+        for file in os.listdir(dir):
+            fp = open(os.path.join(dir, file), 'rb')
+            try:
+                files[file] = fp.read()
+            finally:
+                fp.close()
+        return files
+
+
+class TestMaildirSetAside(MaildirTestCase):
+    # Which ways _claim() may move files
+    renameat2 = True
+    link = True
+
+    def setUp(self):
+        if self.renameat2 and MaildirRunner._renameat2 is None:
+            self.skipTest('renameat2() is not available')
+        MaildirTestCase.setUp(self)
+        self._saved_renameat2 = MaildirRunner._renameat2
+        self._saved_link = os.link
+        if not self.renameat2:
+            MaildirRunner._renameat2 = None
+        if not self.link:
+            def link(*args):
+                raise OSError(errno.EPERM, 'Operation not permitted')
+            os.link = link
+
+    def tearDown(self):
+        MaildirRunner._renameat2 = self._saved_renameat2
+        os.link = self._saved_link
+        MaildirTestCase.tearDown(self)
+
+    def test_stale_and_unroutable(self):
+        eq = self.assertEqual
+        new = self._new
+        cur = self._cur
+        # A runner crashed on `stale', leaving :1,P behind, and `nolist' has
+        # failed before.  Neither earlier file may be overwritten.
+        self._write(os.path.join(new, 'stale'), b'new copy')
+        self._write(os.path.join(cur, 'stale:1,P'), b'crashed copy')
+        self._write(os.path.join(cur, 'stale:1,X'), b'earlier failure')
+        msg = b'Delivered-To: _xnolist@dom.ain\n\nA message\n'
+        self._write(os.path.join(new, 'nolist'), msg)
+        self._write(os.path.join(cur, 'nolist:1,X'), b'earlier failure')
+        eq(self._runner()._oneloop(), 2)
+        eq(os.listdir(new), [])
+        eq(self._files(cur), {
+            'stale:1,P': b'crashed copy',
+            'stale:1,X': b'earlier failure',
+            'stale.1:1,X': b'new copy',
+            'nolist:1,X': b'earlier failure',
+            'nolist.1:1,X': msg,
+            })
+
+
+class TestMaildirSetAsideNoRenameat2(TestMaildirSetAside):
+    renameat2 = False
+
+
+class TestMaildirSetAsideNoLink(TestMaildirSetAside):
+    renameat2 = False
+    link = False
+
+
+
+class TestMaildirOneLoop(MaildirTestCase):
+    def _deliver(self, file, to='_xtest@dom.ain'):
+        self._write(os.path.join(self._new, file),
+                    b'Delivered-To: ' + to.encode() + b'\n'
+                    b'X-File: ' + file.encode() + b'\n'
+                    b'\n'
+                    b'A message\n')
+
+    def _dequeue_all(self, whichq):
+        # Return the X-File: and metadata of everything in the queue
+        sb = self._get_switchboard(whichq)
+        entries = []
+        for filebase in sb.files():
+            msg, data = sb.dequeue(filebase)
+            sb.finish(filebase)
+            entries.append((msg['x-file'], data))
+        return entries
+
+    def test_dispatch(self):
+        eq = self.assertEqual
+        owner = {'toowner': 1, 'pipeline': mm_cfg.OWNER_PIPELINE,
+                 'envsender': Utils.get_site_email(extra='bounces')}
+        table = [
+            ('_xtest-owner', mm_cfg.INQUEUE_DIR, owner),
+            ('_xtest-join', mm_cfg.CMDQUEUE_DIR, {'tojoin': 1}),
+            ('_xtest-subscribe', mm_cfg.CMDQUEUE_DIR, {'tojoin': 1}),
+            ('_xtest-leave', mm_cfg.CMDQUEUE_DIR, {'toleave': 1}),
+            ('_xtest-unsubscribe', mm_cfg.CMDQUEUE_DIR, {'toleave': 1}),
+            ('_xtest-request', mm_cfg.CMDQUEUE_DIR, {'torequest': 1}),
+            ('_xtest-confirm', mm_cfg.CMDQUEUE_DIR, {'toconfirm': 1}),
+            ('_xtest-bounces', mm_cfg.BOUNCEQUEUE_DIR, {}),
+            ('_xtest-admin', mm_cfg.BOUNCEQUEUE_DIR, {}),
+            ('_xtest', mm_cfg.INQUEUE_DIR, {'tolist': 1}),
+            ]
+        for local, whichq, flags in table:
+            self._deliver(local, local + '@dom.ain')
+        eq(self._runner()._oneloop(), len(table))
+        eq(os.listdir(self._new), [])
+        eq(os.listdir(self._cur), [])
+        queued = {}
+        for whichq in (mm_cfg.INQUEUE_DIR, mm_cfg.CMDQUEUE_DIR,
+                       mm_cfg.BOUNCEQUEUE_DIR):
+            for local, data in self._dequeue_all(whichq):
+                for k in ('received_time', 'version', '_parsemsg'):
+                    del data[k]
+                queued[local] = (whichq, data)
+        for local, whichq, flags in table:
+            expected = {'listname': '_xtest'}
+            expected.update(flags)
+            eq(queued[local], (whichq, expected), local)
+
+    def test_slices(self):
+        eq = self.assertEqual
+        files = ['%d.M%dP%d.host' % (1500000000 + i, i, 1000 + i)
+                 for i in range(60)]
+        for file in files:
+            self._deliver(file)
+        # Each slice only takes files nobody has taken yet, and leaves the
+        # other slices' files alone in new/.
+        seen = []
+        for slice in range(3):
+            count = self._runner(slice, 3)._oneloop()
+            got = [file for file, data in
+                   self._dequeue_all(mm_cfg.INQUEUE_DIR)]
+            eq(count, len(got))
+            self.assertTrue(got)
+            eq(set(got) & set(seen), set())
+            seen.extend(got)
+            eq(sorted(os.listdir(self._new)), sorted(set(files) - set(seen)))
+        # Between them the slices took every file exactly once
+        eq(sorted(seen), sorted(files))
+        eq(os.listdir(self._cur), [])
+
+    def test_batch(self):
+        eq = self.assertEqual
+        for i in range(5):
+            self._deliver('msg%d' % i)
+        saved = mm_cfg.MAILDIR_BATCH
+        try:
+            # Each pass stops after MAILDIR_BATCH files, leaving the rest in
+            # new/ for the next one...
+            mm_cfg.MAILDIR_BATCH = 3
+            eq(self._runner()._oneloop(), 3)
+            eq(len(os.listdir(self._new)), 2)
+            eq(len(self._dequeue_all(mm_cfg.INQUEUE_DIR)), 3)
+            # ...and 0 means no limit
+            for i in range(5, 10):
+                self._deliver('msg%d' % i)
+            mm_cfg.MAILDIR_BATCH = 0
+            eq(self._runner()._oneloop(), 7)
+            eq(os.listdir(self._new), [])
+            eq(len(self._dequeue_all(mm_cfg.INQUEUE_DIR)), 7)
+        finally:
+            mm_cfg.MAILDIR_BATCH = saved
+
+
+
+class TestSwitchboardEnqueueFile(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._sb = Switchboard(os.path.join(self._tmpdir, 'q'))
+        # A few MB of raw message, with 8-bit bytes and CRLF line endings
+        self._raw = (b'From: Andr\xc3\xa9 <aperson@dom.ain>\r\n'
+                     b'To: _xtest@dom.ain\r\n'
+                     b'Subject: \xc3\xa9t\xc3\xa9\r\n'
+                     b'\r\n' +
+                     b'A message \xff\x00\r\n' * 250000)
+        self._path = os.path.join(self._tmpdir, 'msg')
+        fp = open(self._path, 'wb')
+        try:
+            fp.write(self._raw)
+        finally:
+            fp.close()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def _load(self, filebase, ext='.pck'):
+        fp = open(os.path.join(self._sb.whichq(), filebase + ext), 'rb')
+        try:
+            msg = pickle.load(fp, fix_imports=True, encoding='latin1')
+            data = pickle.load(fp, fix_imports=True, encoding='latin1')
+        finally:
+            fp.close()
+        return msg, data
+
+    def _check(self, filebase):
+        eq = self.assertEqual
+        raw, data = self._load(filebase)
+        eq(raw, self._raw)
+        eq(data['listname'], '_xtest')
+        eq(data['tolist'], 1)
+        eq(data['_parsemsg'], True)
+        msg, data = self._sb.dequeue(filebase)
+        eq(msg['to'], '_xtest@dom.ain')
+        eq(msg['subject'], '\xe9t\xe9')
+        eq(msg.get_sender(), 'aperson@dom.ain')
+        self._sb.finish(filebase)
+        eq(os.listdir(self._sb.whichq()), [])
+
+    def test_enqueue_file(self):
+        filebase = self._sb.enqueue_file(self._path, {'listname': '_xtest'},
+                                         tolist=1)
+        # The source file is the caller's to remove
+        self.assertTrue(os.path.exists(self._path))
+        self._check(filebase)
+
+    def test_enqueue_file_no_copy_file_range(self):
+        # Pretend the kernel doesn't have copy_file_range()
+        def copy_file_range(*args):
+            raise OSError(errno.ENOSYS, 'Function not implemented')
+        saved = getattr(os, 'copy_file_range', None)
+        os.copy_file_range = copy_file_range
+        try:
+            filebase = self._sb.enqueue_file(self._path,
+                                             {'listname': '_xtest'},
+                                             tolist=1)
+        finally:
+            if saved is None:
+                del os.copy_file_range
+            else:
+                os.copy_file_range = saved
+        self._check(filebase)
+
+    def test_enqueue_file_failed_copy(self):
+        # A copy that fails part way through leaves nothing in the queue
+        def copy_file_range(*args):
+            raise OSError(errno.EIO, 'Input/output error')
+        saved = getattr(os, 'copy_file_range', None)
+        os.copy_file_range = copy_file_range
+        try:
+            self.assertRaises(OSError, self._sb.enqueue_file, self._path,
+                              {'listname': '_xtest'}, tolist=1)
+        finally:
+            if saved is None:
+                del os.copy_file_range
+            else:
+                os.copy_file_range = saved
+        self.assertEqual(os.listdir(self._sb.whichq()), [])
+
+    def test_8bit_headers(self):
+        eq = self.assertEqual
+        # Headers that aren't UTF-8 still come back as strings the rest of
+        # Mailman can use, and the 8-bit body is left as it was.
+        fp = open(self._path, 'wb')
+        try:
+            fp.write(b'From: Andr\xe9 <aperson@dom.ain>\n'
+                     b'Reply-To: bperson@dom.ain\n'
+                     b'Subject: \xe9t\xe9\n'
+                     b'Content-Type: text/plain; charset=iso-8859-1\n'
+                     b'Content-Transfer-Encoding: 8bit\n'
+                     b'\n'
+                     b'\xe9t\xe9\n')
+        finally:
+            fp.close()
+        filebase = self._sb.enqueue_file(self._path, {'listname': '_xtest'})
+        msg, data = self._sb.dequeue(filebase)
+        eq(msg['subject'], '\ufffdt\ufffd')
+        eq(msg.get_sender(), 'aperson@dom.ain')
+        eq(msg.get_senders(headers=('from', 'reply-to')),
+           ['aperson@dom.ain', 'bperson@dom.ain'])
+        eq(msg.get_payload(decode=True), b'\xe9t\xe9\n')
+        self._sb.finish(filebase)
+
+    def test_recover_backup_files(self):
+        eq = self.assertEqual
+        filebase = self._sb.enqueue_file(self._path, {'listname': '_xtest'},
+                                         tolist=1)
+        # Leave the entry as a .bak, as if its runner had crashed
+        self._sb.dequeue(filebase)
+        self._sb.recover_backup_files()
+        raw, data = self._load(filebase)
+        eq(raw, self._raw)
+        eq(data['_bak_count'], 1)
+        self._check(filebase)
+
+
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestPrepMessage))
+    suite.addTest(unittest.makeSuite(TestMaildirRouting))
+    suite.addTest(unittest.makeSuite(TestMaildirSetAside))
+    suite.addTest(unittest.makeSuite(TestMaildirSetAsideNoRenameat2))
+    suite.addTest(unittest.makeSuite(TestMaildirSetAsideNoLink))
+    suite.addTest(unittest.makeSuite(TestMaildirOneLoop))
+    suite.addTest(unittest.makeSuite(TestSwitchboardEnqueueFile))
     return suite
 
 